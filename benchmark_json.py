@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+JSON micro-benchmark for the bot's Telegram payloads
+Compares stdlib json with orjson on update decoding and request encoding
+"""
+
+import json
+import sys
+import timeit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+GEORGIAN_TEXT = "გამარჯობა! როგორ შემიძლია დაგეხმარო დღეს? "
+ENGLISH_TEXT = "Hello! How can I help you today? Here is a detailed answer. "
+
+def make_message(message_id, text):
+    """Build a Telegram message object like the ones the bot receives"""
+    return {
+        "message_id": message_id,
+        "from": {
+            "id": 123456789,
+            "is_bot": False,
+            "first_name": "გიორგი",
+            "last_name": "Smith",
+            "username": "user123",
+            "language_code": "ka"
+        },
+        "chat": {
+            "id": 123456789,
+            "first_name": "გიორგი",
+            "last_name": "Smith",
+            "username": "user123",
+            "type": "private"
+        },
+        "date": 1729300000 + message_id,
+        "text": text
+    }
+
+def make_get_updates_response(count):
+    """getUpdates response with a mix of short and long messages"""
+    updates = []
+    for i in range(count):
+        text = (GEORGIAN_TEXT if i % 2 else ENGLISH_TEXT) * (1 if i % 3 else 8)
+        updates.append({"update_id": 900000000 + i, "message": make_message(i, text)})
+    return json.dumps({"ok": True, "result": updates}, ensure_ascii=False)
+
+def make_edit_message_response():
+    """editMessageText response carrying a long (~3000 token) AI answer"""
+    text = (ENGLISH_TEXT + GEORGIAN_TEXT) * 60
+    return json.dumps({"ok": True, "result": make_message(1, text)}, ensure_ascii=False)
+
+def make_keyboard():
+    """Main menu inline keyboard, as sent in reply_markup"""
+    return {
+        "inline_keyboard": [
+            [
+                {"text": "🗑️ ახალი საუბარი", "callback_data": "newchat"},
+                {"text": "📊 სტატისტიკა", "callback_data": "stats"}
+            ],
+            [
+                {"text": "⚙️ პარამეტრები", "callback_data": "settings"},
+                {"text": "ℹ️ დახმარება", "callback_data": "help"}
+            ]
+        ]
+    }
+
+def make_send_message_request():
+    """sendMessage request body with a long answer and a keyboard"""
+    return {
+        "chat_id": 123456789,
+        "text": (ENGLISH_TEXT + GEORGIAN_TEXT) * 60,
+        "parse_mode": "HTML",
+        "reply_markup": make_keyboard()
+    }
+
+def bench(func, number):
+    """Best per-call time in microseconds"""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1_000_000
+
+def main():
+    if orjson is None:
+        sys.exit("❌ orjson is not installed: pip install orjson")
+
+    decode_cases = [
+        ("getUpdates, 1 update", make_get_updates_response(1)),
+        ("getUpdates, 10 updates", make_get_updates_response(10)),
+        ("getUpdates, 100 updates", make_get_updates_response(100)),
+        ("editMessageText response", make_edit_message_response())
+    ]
+    encode_cases = [
+        ("reply_markup keyboard", make_keyboard()),
+        ("sendMessage body", make_send_message_request())
+    ]
+
+    print("📊 JSON micro-benchmark (µs per call, lower is better)")
+    print("=" * 72)
+    print(f"{'payload':<28}{'size':>10}{'json':>11}{'orjson':>11}{'speedup':>10}")
+    print("-" * 72)
+
+    print("Decode")
+    for name, raw in decode_cases:
+        number = max(10, 20000 // (len(raw) // 100 + 1))
+        stdlib = bench(lambda: json.loads(raw), number)
+        fast = bench(lambda: orjson.loads(raw), number)
+        print(f"  {name:<26}{len(raw.encode()):>9}B{stdlib:>11.1f}{fast:>11.1f}{stdlib / fast:>9.1f}x")
+
+    print("Encode")
+    for name, obj in encode_cases:
+        size = len(json.dumps(obj).encode())
+        number = max(10, 20000 // (size // 100 + 1))
+        stdlib = bench(lambda: json.dumps(obj), number)
+        # Same wrapper as get_json_backend() in bot.py
+        fast = bench(lambda: orjson.dumps(obj).decode(), number)
+        print(f"  {name:<26}{size:>9}B{stdlib:>11.1f}{fast:>11.1f}{stdlib / fast:>9.1f}x")
+
+    print("-" * 72)
+    print("ℹ️  aiogram only JSON-encodes nested fields such as reply_markup;")
+    print("   plain fields like text are sent as form values.")
+
+if __name__ == "__main__":
+    main()
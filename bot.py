@@ -1,21 +1,27 @@
 import asyncio
+import json
 import logging
 import sys
 import re
+import time
+from collections import OrderedDict
 from os import getenv
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Callable, Tuple, Any
 
 import aiosqlite
 from dotenv import load_dotenv
-from anthropic import Anthropic, APIError
+from anthropic import AsyncAnthropic, APIError
+from asyncio_throttle import Throttler
 from chatgpt_md_converter import telegram_format
 
 from aiogram import Bot, Dispatcher, F, html
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, Update, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 # Load environment variables
@@ -26,25 +32,145 @@ TELEGRAM_TOKEN = getenv("TELEGRAM_TOKEN")
 LANGDOCK_API_KEY = getenv("LANGDOCK_API_KEY")
 ADMIN_USER_ID = getenv("ADMIN_USER_ID")
 
+# Path to a JSON file describing several bots (tenants) served by this process
+TENANTS_CONFIG = getenv("TENANTS_CONFIG")
+
+# Max LLM requests per second, shared by all tenants
+LLM_RATE_LIMIT = int(getenv("LLM_RATE_LIMIT", "10"))
+
+# Update dedup ledger: recently seen updates kept in memory, and how long
+# rows are kept in SQLite (Telegram drops undelivered updates after 24h)
+LEDGER_CACHE_SIZE = int(getenv("LEDGER_CACHE_SIZE", "10000"))
+LEDGER_RETENTION_HOURS = int(getenv("LEDGER_RETENTION_HOURS", "48"))
+LEDGER_MAX_ATTEMPTS = int(getenv("LEDGER_MAX_ATTEMPTS", "3"))
+LEDGER_PRUNE_EVERY = 1000
+
+# Polling confirms an update as soon as it is handed to a handler, so a turn
+# interrupted by a restart is usually not redelivered. In-flight rows idle for
+# longer than the grace period are swept (resumed or finalized) periodically.
+LEDGER_RESUME_GRACE_SECONDS = int(getenv("LEDGER_RESUME_GRACE_SECONDS", "120"))
+LEDGER_SWEEP_INTERVAL_SECONDS = int(getenv("LEDGER_SWEEP_INTERVAL_SECONDS", "60"))
+
+# Runtime profile: 'performance' (uvloop + orjson when installed) or 'standard' (stdlib only)
+RUNTIME_PROFILE = getenv("RUNTIME_PROFILE", "performance").lower()
+
 # Anthropic/Langdock API settings
 ANTHROPIC_BASE_URL = "https://api.langdock.com/anthropic/eu/"
 ANTHROPIC_MODEL = "claude-3-5-sonnet-20240620"
+ANTHROPIC_FAST_MODEL = getenv("ANTHROPIC_FAST_MODEL", "claude-3-haiku-20240307")
+
+# Model routing settings
+ROUTING_ENABLED = getenv("ROUTING_ENABLED", "true").lower() in ("1", "true", "yes")
+ROUTING_MAX_FAST_CONTEXT = int(getenv("ROUTING_MAX_FAST_CONTEXT", "6"))
+ROUTING_LOG_RETENTION_DAYS = int(getenv("ROUTING_LOG_RETENTION_DAYS", "30"))
+
+# Model tiers: which model, how many tokens and what temperature each tier uses
+MODEL_TIERS = {
+    'fast': {
+        'model': ANTHROPIC_FAST_MODEL,
+        'max_tokens': int(getenv("ROUTING_FAST_MAX_TOKENS", "800")),
+        'temperature': 0.7
+    },
+    'standard': {
+        'model': ANTHROPIC_MODEL,
+        'max_tokens': int(getenv("ROUTING_STANDARD_MAX_TOKENS", "3000")),
+        'temperature': 0.7
+    }
+}
+
+# Messages shorter than this (in characters) count as simple turns.
+# Georgian words are longer and the fast model is weaker in Georgian,
+# so non-English turns get a tighter limit.
+ROUTING_SHORT_MESSAGE_CHARS = {
+    'english': int(getenv("ROUTING_SHORT_CHARS_ENGLISH", "80")),
+    'georgian': int(getenv("ROUTING_SHORT_CHARS_GEORGIAN", "40")),
+    'mixed': int(getenv("ROUTING_SHORT_CHARS_MIXED", "40"))
+}
 
 # Check required tokens
-if not TELEGRAM_TOKEN or not LANGDOCK_API_KEY:
-    sys.exit("Error: TELEGRAM_TOKEN and LANGDOCK_API_KEY must be set in .env file")
+if not (TELEGRAM_TOKEN or TENANTS_CONFIG) or not LANGDOCK_API_KEY:
+    sys.exit("Error: TELEGRAM_TOKEN (or TENANTS_CONFIG) and LANGDOCK_API_KEY must be set in .env file")
+
+def get_bot_id(token: str) -> int:
+    """Get bot id from its token (the part before the colon)"""
+    return int(token.split(':', 1)[0])
+
+def load_tenants() -> Dict[int, Dict]:
+    """Load tenant bots, keyed by bot id.
+    
+    TENANTS_CONFIG points to a JSON list of objects with a "name", either a
+    "token" or a "token_env" (name of the env variable holding the token),
+    and optional "prompts" overriding SYSTEM_PROMPTS per language.
+    Without TENANTS_CONFIG, TELEGRAM_TOKEN is served as the only tenant.
+    """
+    if not TENANTS_CONFIG:
+        return {get_bot_id(TELEGRAM_TOKEN): {'name': 'default', 'token': TELEGRAM_TOKEN, 'prompts': {}}}
+    
+    with open(TENANTS_CONFIG, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    
+    tenants = {}
+    for entry in entries:
+        token = entry.get('token') or getenv(entry.get('token_env', ''))
+        if not token:
+            raise ValueError(f"Tenant {entry.get('name')!r} has no token")
+        bot_id = get_bot_id(token)
+        if bot_id in tenants:
+            raise ValueError(f"Tenant {entry.get('name')!r} duplicates bot id {bot_id} of tenant {tenants[bot_id]['name']!r}")
+        tenants[bot_id] = {
+            'name': entry.get('name', 'default'),
+            'token': token,
+            'prompts': entry.get('prompts', {})
+        }
+    if not tenants:
+        raise ValueError("No tenants configured")
+    return tenants
+
+try:
+    TENANTS = load_tenants()
+except Exception as e:
+    sys.exit(f"Error loading tenants: {e}")
+
+# The first tenant owns data created before multi-tenant mode
+PRIMARY_BOT_ID = next(iter(TENANTS))
 
-# --- Initialize Anthropic client ---
+# --- Initialize Anthropic client (shared by all tenants) ---
 try:
-    anthropic_client = Anthropic(
+    anthropic_client = AsyncAnthropic(
         base_url=ANTHROPIC_BASE_URL,
         api_key=LANGDOCK_API_KEY
     )
 except Exception as e:
     sys.exit(f"Error initializing Anthropic client: {e}")
 
+llm_throttler = Throttler(rate_limit=LLM_RATE_LIMIT, period=1.0)
+
 dp = Dispatcher()
 
+def install_event_loop() -> str:
+    """Install uvloop for the performance profile, falling back to asyncio"""
+    if RUNTIME_PROFILE == 'performance':
+        try:
+            import uvloop
+        except ImportError:
+            logging.warning("uvloop is not installed, using the default asyncio event loop")
+        else:
+            uvloop.install()
+            return 'uvloop'
+    return 'asyncio'
+
+def get_json_backend() -> Tuple[Callable, Callable, str]:
+    """Get JSON loads/dumps for the Bot session, falling back to stdlib json"""
+    if RUNTIME_PROFILE == 'performance':
+        try:
+            import orjson
+        except ImportError:
+            logging.warning("orjson is not installed, using stdlib json")
+        else:
+            # aiogram expects json_dumps to return str, orjson returns bytes
+            return orjson.loads, lambda obj: orjson.dumps(obj).decode(), 'orjson'
+    return json.loads, json.dumps, 'json'
+
 # --- Database ---
 DB_PATH = "ai_agent.db"
 
@@ -52,6 +178,9 @@ DB_PATH = "ai_agent.db"
 GEORGIAN_PATTERN = re.compile(r'[\u10A0-\u10FF]')
 ENGLISH_PATTERN = re.compile(r'[a-zA-Z]')
 
+# Signs that a turn needs the full model regardless of its length
+COMPLEX_PATTERN = re.compile(r'```|https?://|\n\s*\n|[{}<>=;]')
+
 # System prompts for different languages
 SYSTEM_PROMPTS = {
     'georgian': """შენ ხარ ძალიან ჭკვიანი და მეგობრული AI პერსონალური ასისტენტი. შენი მიზანია:
@@ -111,13 +240,42 @@ If the user writes in English - respond in English.
 🤖 You're a personal AI assistant and friend!"""
 }
 
+async def get_table_columns(db, table: str) -> List[str]:
+    """Get column names of a table (empty if the table doesn't exist)"""
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in await cursor.fetchall()]
+
 async def init_db():
-    """Initialize database with enhanced schema"""
+    """Initialize database with enhanced schema.
+    
+    All tables are partitioned by bot_id. Databases created before
+    multi-tenant mode are migrated in place and their rows are assigned
+    to PRIMARY_BOT_ID. Everything runs in one transaction, so a crash
+    mid-migration leaves the old schema intact.
+    """
     async with aiosqlite.connect(DB_PATH) as db:
+        # sqlite3 runs DDL in autocommit unless a transaction is open
+        await db.execute("BEGIN")
+        
+        # Tables keyed by user_id alone must be rebuilt with a composite key
+        legacy_tables = []
+        for table in ('user_profiles', 'user_preferences'):
+            # Left over from an interrupted non-transactional migration
+            legacy_columns = await get_table_columns(db, f"{table}_legacy")
+            if legacy_columns:
+                legacy_tables.append((table, legacy_columns))
+                continue
+            
+            columns = await get_table_columns(db, table)
+            if columns and 'bot_id' not in columns:
+                await db.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+                legacy_tables.append((table, columns))
+        
         # Chat context table
         await db.execute("""
             CREATE TABLE IF NOT EXISTS chat_context (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bot_id INTEGER NOT NULL DEFAULT 0,
                 user_id INTEGER NOT NULL,
                 role TEXT NOT NULL,
                 content TEXT NOT NULL,
@@ -128,31 +286,92 @@ async def init_db():
         # User profiles table
         await db.execute("""
             CREATE TABLE IF NOT EXISTS user_profiles (
-                user_id INTEGER PRIMARY KEY,
+                bot_id INTEGER NOT NULL DEFAULT 0,
+                user_id INTEGER NOT NULL,
                 username TEXT,
                 first_name TEXT,
                 last_name TEXT,
                 preferred_language TEXT DEFAULT 'mixed',
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                 last_active DATETIME DEFAULT CURRENT_TIMESTAMP,
-                message_count INTEGER DEFAULT 0
+                message_count INTEGER DEFAULT 0,
+                PRIMARY KEY (bot_id, user_id)
             )
         """)
         
         # User preferences table
         await db.execute("""
             CREATE TABLE IF NOT EXISTS user_preferences (
-                user_id INTEGER PRIMARY KEY,
+                bot_id INTEGER NOT NULL DEFAULT 0,
+                user_id INTEGER NOT NULL,
                 context_length INTEGER DEFAULT 20,
                 response_style TEXT DEFAULT 'balanced',
                 timezone TEXT DEFAULT 'UTC',
-                FOREIGN KEY (user_id) REFERENCES user_profiles (user_id)
+                PRIMARY KEY (bot_id, user_id),
+                FOREIGN KEY (bot_id, user_id) REFERENCES user_profiles (bot_id, user_id)
+            )
+        """)
+        
+        # Model routing log table
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS model_routing_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bot_id INTEGER NOT NULL DEFAULT 0,
+                user_id INTEGER NOT NULL,
+                tier TEXT NOT NULL,
+                model TEXT NOT NULL,
+                reason TEXT,
+                max_tokens INTEGER,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                latency_ms INTEGER,
+                stop_reason TEXT,
+                success INTEGER DEFAULT 1,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         """)
         
+        # Update dedup ledger table
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS update_ledger (
+                bot_id INTEGER NOT NULL,
+                update_id INTEGER NOT NULL,
+                chat_id INTEGER,
+                message_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'in_flight',
+                stage TEXT NOT NULL DEFAULT 'received',
+                placeholder_message_id INTEGER,
+                answer TEXT,
+                attempts INTEGER DEFAULT 1,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (bot_id, update_id)
+            ) WITHOUT ROWID
+        """)
+        
+        # Migrate pre-tenant data to the primary bot
+        for table, columns in legacy_tables:
+            column_list = ", ".join(columns)
+            await db.execute(f"""
+                INSERT OR IGNORE INTO {table} (bot_id, {column_list})
+                SELECT ?, {column_list} FROM {table}_legacy
+            """, (PRIMARY_BOT_ID,))
+            await db.execute(f"DROP TABLE {table}_legacy")
+        
+        for table in ('chat_context', 'model_routing_log'):
+            if 'bot_id' not in await get_table_columns(db, table):
+                await db.execute(f"ALTER TABLE {table} ADD COLUMN bot_id INTEGER NOT NULL DEFAULT 0")
+                await db.execute(f"UPDATE {table} SET bot_id = ?", (PRIMARY_BOT_ID,))
+        
         # Create indexes
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_user_id_timestamp ON chat_context(user_id, timestamp)")
+        await db.execute("DROP INDEX IF EXISTS idx_user_id_timestamp")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_bot_user_timestamp ON chat_context(bot_id, user_id, timestamp)")
         await db.execute("CREATE INDEX IF NOT EXISTS idx_user_last_active ON user_profiles(last_active)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_routing_timestamp ON model_routing_log(timestamp)")
+        await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_ledger_message ON update_ledger(bot_id, chat_id, message_id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_ledger_updated_at ON update_ledger(updated_at)")
+        
+        await prune_ledger(db)
+        await prune_routing_log(db)
         
         await db.commit()
 
@@ -168,36 +387,47 @@ async def detect_language(text: str) -> str:
     else:
         return 'mixed'
 
-async def update_user_profile(message: Message):
+async def update_user_profile(bot_id: int, message: Message):
     """Update or create user profile"""
     user = message.from_user
     async with aiosqlite.connect(DB_PATH) as db:
         await db.execute("""
             INSERT OR REPLACE INTO user_profiles 
-            (user_id, username, first_name, last_name, last_active, message_count)
-            VALUES (?, ?, ?, ?, ?, 
-                COALESCE((SELECT message_count FROM user_profiles WHERE user_id = ?), 0) + 1)
-        """, (user.id, user.username, user.first_name, user.last_name, datetime.now(), user.id))
+            (bot_id, user_id, username, first_name, last_name, last_active, message_count)
+            VALUES (?, ?, ?, ?, ?, ?, 
+                COALESCE((SELECT message_count FROM user_profiles WHERE bot_id = ? AND user_id = ?), 0) + 1)
+        """, (bot_id, user.id, user.username, user.first_name, user.last_name, datetime.now(), bot_id, user.id))
         
         # Initialize preferences if not exists
         await db.execute("""
-            INSERT OR IGNORE INTO user_preferences (user_id) VALUES (?)
-        """, (user.id,))
+            INSERT OR IGNORE INTO user_preferences (bot_id, user_id) VALUES (?, ?)
+        """, (bot_id, user.id))
         
         await db.commit()
 
-async def add_message_to_context(user_id: int, role: str, content: str):
-    """Add message to user context with intelligent cleanup"""
+async def add_message_to_context(bot_id: int, user_id: int, role: str, content: str,
+                                 ledger_entry: Optional[Dict] = None, ledger_stage: Optional[str] = None):
+    """Add message to user context with intelligent cleanup.
+    
+    If ledger_stage is given, the update's stage is recorded in the same
+    transaction (with the answer itself for the 'answered' stage).
+    """
     async with aiosqlite.connect(DB_PATH) as db:
         await db.execute(
-            "INSERT INTO chat_context (user_id, role, content) VALUES (?, ?, ?)",
-            (user_id, role, content)
+            "INSERT INTO chat_context (bot_id, user_id, role, content) VALUES (?, ?, ?, ?)",
+            (bot_id, user_id, role, content)
         )
         
+        if ledger_entry and ledger_stage:
+            await write_update_stage(
+                db, ledger_entry, ledger_stage,
+                answer=content if ledger_stage == 'answered' else None
+            )
+        
         # Get user's preferred context length
         cursor = await db.execute(
-            "SELECT context_length FROM user_preferences WHERE user_id = ?",
-            (user_id,)
+            "SELECT context_length FROM user_preferences WHERE bot_id = ? AND user_id = ?",
+            (bot_id, user_id)
         )
         result = await cursor.fetchone()
         context_length = result[0] if result else 20
@@ -205,39 +435,39 @@ async def add_message_to_context(user_id: int, role: str, content: str):
         # Keep only recent messages
         await db.execute("""
             DELETE FROM chat_context 
-            WHERE user_id = ? AND id NOT IN (
+            WHERE bot_id = ? AND user_id = ? AND id NOT IN (
                 SELECT id FROM chat_context 
-                WHERE user_id = ? 
+                WHERE bot_id = ? AND user_id = ? 
                 ORDER BY timestamp DESC 
                 LIMIT ?
             )
-        """, (user_id, user_id, context_length))
+        """, (bot_id, user_id, bot_id, user_id, context_length))
         
         await db.commit()
 
-async def get_user_context(user_id: int) -> List[Dict]:
+async def get_user_context(bot_id: int, user_id: int) -> List[Dict]:
     """Get user conversation context"""
     async with aiosqlite.connect(DB_PATH) as db:
         cursor = await db.execute(
-            "SELECT role, content FROM chat_context WHERE user_id = ? ORDER BY timestamp ASC",
-            (user_id,)
+            "SELECT role, content FROM chat_context WHERE bot_id = ? AND user_id = ? ORDER BY timestamp ASC",
+            (bot_id, user_id)
         )
         rows = await cursor.fetchall()
         return [{"role": row[0], "content": row[1]} for row in rows]
 
-async def clear_user_context(user_id: int):
+async def clear_user_context(bot_id: int, user_id: int):
     """Clear user conversation context"""
     async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM chat_context WHERE user_id = ?", (user_id,))
+        await db.execute("DELETE FROM chat_context WHERE bot_id = ? AND user_id = ?", (bot_id, user_id))
         await db.commit()
 
-async def get_user_stats(user_id: int) -> Dict:
+async def get_user_stats(bot_id: int, user_id: int) -> Dict:
     """Get user statistics"""
     async with aiosqlite.connect(DB_PATH) as db:
         cursor = await db.execute("""
             SELECT message_count, created_at, preferred_language 
-            FROM user_profiles WHERE user_id = ?
-        """, (user_id,))
+            FROM user_profiles WHERE bot_id = ? AND user_id = ?
+        """, (bot_id, user_id))
         result = await cursor.fetchone()
         
         if result:
@@ -248,6 +478,418 @@ async def get_user_stats(user_id: int) -> Dict:
             }
         return {}
 
+async def get_user_preferences(bot_id: int, user_id: int) -> Dict:
+    """Get user preferences"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute("""
+            SELECT context_length, response_style, timezone
+            FROM user_preferences WHERE bot_id = ? AND user_id = ?
+        """, (bot_id, user_id))
+        result = await cursor.fetchone()
+        
+        if result:
+            return {
+                'context_length': result[0],
+                'response_style': result[1],
+                'timezone': result[2]
+            }
+        return {'context_length': 20, 'response_style': 'balanced', 'timezone': 'UTC'}
+
+def get_system_prompt(bot_id: int, language: str) -> str:
+    """Get a tenant's system prompt, falling back to the default SYSTEM_PROMPTS"""
+    prompts = {**SYSTEM_PROMPTS, **TENANTS.get(bot_id, {}).get('prompts', {})}
+    return prompts.get(language, prompts['mixed'])
+
+def route_model(text: str, language: str, context_depth: int, response_style: str) -> Dict:
+    """Pick model tier and max_tokens for a turn.
+    
+    Classification is cheap on purpose: message length (per language),
+    complexity markers, conversation depth and the user's response style.
+    """
+    if not ROUTING_ENABLED:
+        return {'tier': 'standard', 'reason': 'routing_disabled', **MODEL_TIERS['standard']}
+    
+    short_limit = ROUTING_SHORT_MESSAGE_CHARS.get(language, ROUTING_SHORT_MESSAGE_CHARS['mixed'])
+    is_short = len(text) <= short_limit
+    is_complex = COMPLEX_PATTERN.search(text) is not None
+    
+    if response_style == 'detailed':
+        tier, reason = 'standard', 'style_detailed'
+    elif is_complex:
+        tier, reason = 'standard', 'complex_content'
+    elif response_style == 'concise' and len(text) <= short_limit * 3:
+        tier, reason = 'fast', 'style_concise'
+    elif is_short and context_depth <= ROUTING_MAX_FAST_CONTEXT:
+        tier, reason = 'fast', 'short_message'
+    elif is_short:
+        tier, reason = 'standard', 'deep_context'
+    else:
+        tier, reason = 'standard', 'long_message'
+    
+    route = {'tier': tier, 'reason': reason, **MODEL_TIERS[tier]}
+    if response_style == 'concise':
+        route['max_tokens'] = max(256, route['max_tokens'] // 2)
+    return route
+
+async def log_routing_decision(bot_id: int, user_id: int, route: Dict, latency_ms: int,
+                               input_tokens: Optional[int] = None,
+                               output_tokens: Optional[int] = None,
+                               stop_reason: Optional[str] = None,
+                               success: bool = True):
+    """Record a routing decision with its latency and token usage"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute("""
+            INSERT INTO model_routing_log
+            (bot_id, user_id, tier, model, reason, max_tokens, input_tokens, output_tokens,
+             latency_ms, stop_reason, success)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (bot_id, user_id, route['tier'], route['model'], route['reason'], route['max_tokens'],
+              input_tokens, output_tokens, latency_ms, stop_reason, int(success)))
+        await db.commit()
+
+async def prune_routing_log(db):
+    """Delete routing log rows older than ROUTING_LOG_RETENTION_DAYS"""
+    await db.execute(
+        "DELETE FROM model_routing_log WHERE timestamp < datetime('now', ?)",
+        (f"-{ROUTING_LOG_RETENTION_DAYS} days",)
+    )
+
+async def call_model(bot_id: int, user_id: int, route: Dict, api_messages: List[Dict]):
+    """Call Anthropic API with a route and record the decision"""
+    started = time.monotonic()
+    try:
+        # Rate limit is shared by all tenants
+        async with llm_throttler:
+            response = await anthropic_client.messages.create(
+                model=route['model'],
+                messages=api_messages,
+                max_tokens=route['max_tokens'],
+                temperature=route['temperature']
+            )
+    except APIError:
+        await log_routing_decision(bot_id, user_id, route, int((time.monotonic() - started) * 1000), success=False)
+        raise
+    latency_ms = int((time.monotonic() - started) * 1000)
+    
+    await log_routing_decision(
+        bot_id, user_id, route, latency_ms,
+        input_tokens=response.usage.input_tokens,
+        output_tokens=response.usage.output_tokens,
+        stop_reason=response.stop_reason
+    )
+    logging.info(
+        f"Routed user {user_id} to {route['tier']} ({route['model']}, {route['reason']}) "
+        f"in {latency_ms}ms, stop: {response.stop_reason}"
+    )
+    return response
+
+async def get_routing_stats(bot_id: int, days: int = 7) -> List[Dict]:
+    """Get per-tier routing statistics for a bot over the last N days"""
+    since = datetime.utcnow() - timedelta(days=days)
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute("""
+            SELECT tier, model, COUNT(*), AVG(latency_ms),
+                   SUM(COALESCE(input_tokens, 0)), SUM(COALESCE(output_tokens, 0)),
+                   SUM(1 - success), SUM(stop_reason = 'max_tokens')
+            FROM model_routing_log
+            WHERE bot_id = ? AND timestamp >= ?
+            GROUP BY tier, model
+            ORDER BY tier
+        """, (bot_id, since.strftime('%Y-%m-%d %H:%M:%S')))
+        rows = await cursor.fetchall()
+        return [
+            {
+                'tier': row[0],
+                'model': row[1],
+                'requests': row[2],
+                'avg_latency_ms': int(row[3] or 0),
+                'input_tokens': row[4],
+                'output_tokens': row[5],
+                'failures': row[6],
+                'truncated': row[7] or 0
+            }
+            for row in rows
+        ]
+
+# --- Update dedup ledger ---
+# Updates handled by this process right now, and an LRU of finished ones.
+# Both are checked before touching SQLite, so most duplicates are dropped
+# without a query.
+ledger_in_flight = set()
+ledger_cache = OrderedDict()
+ledger_claims = 0
+
+def get_ledger_keys(bot_id: int, update_id: int, chat_id: Optional[int], message_id: Optional[int]) -> List[Tuple]:
+    """Get in-memory keys of an update: its update_id and, for messages, its message_id"""
+    keys = [('update', bot_id, update_id)]
+    if message_id is not None:
+        keys.append(('message', bot_id, chat_id, message_id))
+    return keys
+
+def remember_ledger_keys(keys: List[Tuple], status: str):
+    """Add finished update keys to the LRU cache"""
+    for key in keys:
+        ledger_cache[key] = status
+        ledger_cache.move_to_end(key)
+    while len(ledger_cache) > LEDGER_CACHE_SIZE:
+        ledger_cache.popitem(last=False)
+
+async def prune_ledger(db):
+    """Delete ledger rows older than LEDGER_RETENTION_HOURS"""
+    await db.execute(
+        "DELETE FROM update_ledger WHERE updated_at < datetime('now', ?)",
+        (f"-{LEDGER_RETENTION_HOURS} hours",)
+    )
+
+async def claim_update(bot_id: int, update_id: int, chat_id: Optional[int] = None,
+                       message_id: Optional[int] = None) -> Optional[Dict]:
+    """Claim an update for processing.
+    
+    Returns a ledger entry, or None if the update is a duplicate. Updates
+    left in_flight by a previous process are returned with resumed=True
+    so the handler can continue from the last recorded stage.
+    """
+    global ledger_claims
+    keys = get_ledger_keys(bot_id, update_id, chat_id, message_id)
+    if any(key in ledger_in_flight or key in ledger_cache for key in keys):
+        return None
+    
+    # Reserve the keys before the first await so concurrent copies are dropped
+    ledger_in_flight.update(keys)
+    try:
+        async with aiosqlite.connect(DB_PATH) as db:
+            cursor = await db.execute("""
+                INSERT OR IGNORE INTO update_ledger (bot_id, update_id, chat_id, message_id)
+                VALUES (?, ?, ?, ?)
+            """, (bot_id, update_id, chat_id, message_id))
+            
+            if cursor.rowcount == 1:
+                entry = {
+                    'update_id': update_id,
+                    'status': 'in_flight',
+                    'stage': 'received',
+                    'placeholder_message_id': None,
+                    'answer': None,
+                    'attempts': 1,
+                    'resumed': False
+                }
+            else:
+                cursor = await db.execute("""
+                    SELECT update_id, status, stage, placeholder_message_id, attempts, answer
+                    FROM update_ledger
+                    WHERE bot_id = ? AND (update_id = ? OR (chat_id = ? AND message_id = ?))
+                """, (bot_id, update_id, chat_id, message_id))
+                row = await cursor.fetchone()
+                
+                if row is None or row[1] != 'in_flight':
+                    ledger_in_flight.difference_update(keys)
+                    remember_ledger_keys(keys, row[1] if row else 'completed')
+                    return None
+                
+                # Interrupted by a restart: resume it, unless the sweeper took it first
+                cursor = await db.execute("""
+                    UPDATE update_ledger SET attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+                    WHERE bot_id = ? AND update_id = ? AND status = 'in_flight' AND attempts = ?
+                """, (bot_id, row[0], row[4]))
+                if cursor.rowcount != 1:
+                    ledger_in_flight.difference_update(keys)
+                    return None
+                entry = {
+                    'update_id': row[0],
+                    'status': 'in_flight',
+                    'stage': row[2],
+                    'placeholder_message_id': row[3],
+                    'attempts': row[4] + 1,
+                    'answer': row[5],
+                    'resumed': True
+                }
+            
+            ledger_claims += 1
+            if ledger_claims % LEDGER_PRUNE_EVERY == 0:
+                await prune_ledger(db)
+            await db.commit()
+    except Exception:
+        ledger_in_flight.difference_update(keys)
+        raise
+    
+    entry.update({'bot_id': bot_id, 'chat_id': chat_id, 'keys': keys})
+    return entry
+
+async def write_update_stage(db, entry: Dict, stage: str, placeholder_message_id: Optional[int] = None,
+                             answer: Optional[str] = None):
+    """Record the stage an in-flight update has reached (caller commits)"""
+    entry['stage'] = stage
+    if placeholder_message_id is not None:
+        entry['placeholder_message_id'] = placeholder_message_id
+    if answer is not None:
+        entry['answer'] = answer
+    await db.execute("""
+        UPDATE update_ledger
+        SET stage = ?, placeholder_message_id = ?, answer = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE bot_id = ? AND update_id = ?
+    """, (stage, entry['placeholder_message_id'], entry['answer'], entry['bot_id'], entry['update_id']))
+
+async def advance_update(entry: Optional[Dict], stage: str, placeholder_message_id: Optional[int] = None):
+    """Record the stage an in-flight update has reached"""
+    if not entry:
+        return
+    async with aiosqlite.connect(DB_PATH) as db:
+        await write_update_stage(db, entry, stage, placeholder_message_id)
+        await db.commit()
+
+async def write_update_status(bot_id: int, update_id: int, status: str):
+    """Persist the final status of an update"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute("""
+            UPDATE update_ledger SET status = ?, answer = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE bot_id = ? AND update_id = ? AND status = 'in_flight'
+        """, (status, bot_id, update_id))
+        await db.commit()
+
+async def finish_update(entry: Optional[Dict], status: str):
+    """Mark an update as completed or failed (only the first call counts)"""
+    if not entry or entry['status'] != 'in_flight':
+        return
+    entry['status'] = status
+    try:
+        await write_update_status(entry['bot_id'], entry['update_id'], status)
+    finally:
+        # Release the keys even if the write fails, or the update would be
+        # treated as a duplicate for the life of the process
+        ledger_in_flight.difference_update(entry['keys'])
+        remember_ledger_keys(entry['keys'], status)
+
+async def deliver_answer(bot: Bot, chat_id: int, message_id: int, answer: str):
+    """Edit the placeholder with a saved answer.
+    
+    When resuming, the edit may already have reached the user before the
+    interruption; Telegram then reports "message is not modified".
+    """
+    try:
+        await bot.edit_message_text(telegram_format(answer), chat_id=chat_id, message_id=message_id)
+    except TelegramBadRequest as e:
+        if 'message is not modified' not in str(e):
+            raise
+
+async def finalize_interrupted_update(bot: Optional[Bot], entry: Dict):
+    """Give up on an interrupted update and close its placeholder"""
+    logging.warning(f"Giving up on interrupted update {entry['update_id']} (attempt {entry['attempts']})")
+    if bot and entry['placeholder_message_id'] and entry['chat_id']:
+        try:
+            await bot.edit_message_text(
+                "😕 Something went wrong. Please try again.\n😕 რაღაც არასწორად მოხდა. სცადეთ თავიდან.",
+                chat_id=entry['chat_id'],
+                message_id=entry['placeholder_message_id']
+            )
+        except Exception as e:
+            logging.error(f"Could not finalize placeholder: {e}")
+    await finish_update(entry, 'failed')
+
+async def dedup_middleware(handler, event: Update, data: Dict[str, Any]) -> Any:
+    """Drop redelivered updates and track every update in the ledger"""
+    bot = data['bot']
+    message = event.message
+    entry = await claim_update(
+        bot.id,
+        event.update_id,
+        message.chat.id if message else None,
+        message.message_id if message else None
+    )
+    if entry is None:
+        logging.info(f"Dropped duplicate update {event.update_id}")
+        return None
+    
+    if entry['attempts'] > LEDGER_MAX_ATTEMPTS:
+        await finalize_interrupted_update(bot, entry)
+        return None
+    if entry['resumed']:
+        logging.info(f"Resuming interrupted update {entry['update_id']} from stage {entry['stage']}")
+    
+    data['ledger_entry'] = entry
+    try:
+        result = await handler(event, data)
+    except Exception:
+        await finish_update(entry, 'failed')
+        raise
+    await finish_update(entry, 'completed')
+    return result
+
+dp.update.outer_middleware(dedup_middleware)
+
+async def recover_interrupted_updates(bots: List[Bot]):
+    """Resume or finalize turns left in_flight by a previous process.
+    
+    Turns whose answer was already saved get it delivered; earlier stages
+    have no message to resume from, so their placeholder is finalized.
+    """
+    bots_by_id = {bot.id: bot for bot in bots}
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute("""
+            SELECT bot_id, update_id, chat_id, message_id, stage, placeholder_message_id, attempts, answer
+            FROM update_ledger
+            WHERE status = 'in_flight' AND updated_at < datetime('now', ?)
+        """, (f"-{LEDGER_RESUME_GRACE_SECONDS} seconds",))
+        rows = await cursor.fetchall()
+    
+    for row in rows:
+        keys = get_ledger_keys(row[0], row[1], row[2], row[3])
+        # Still being handled by this process (e.g. a slow LLM call)
+        if any(key in ledger_in_flight for key in keys):
+            continue
+        # Finished here, but writing the final status failed: retry the write
+        cached = next((ledger_cache[key] for key in keys if key in ledger_cache), None)
+        if cached:
+            await write_update_status(row[0], row[1], cached)
+            continue
+        
+        # Reserve the keys before the first await so a redelivered copy is dropped
+        ledger_in_flight.update(keys)
+        try:
+            # Take ownership only if nobody else claimed the row meanwhile
+            async with aiosqlite.connect(DB_PATH) as db:
+                cursor = await db.execute("""
+                    UPDATE update_ledger SET attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+                    WHERE bot_id = ? AND update_id = ? AND status = 'in_flight' AND attempts = ?
+                """, (row[0], row[1], row[6]))
+                await db.commit()
+            if cursor.rowcount != 1:
+                continue
+            
+            entry = {
+                'bot_id': row[0],
+                'update_id': row[1],
+                'chat_id': row[2],
+                'status': 'in_flight',
+                'stage': row[4],
+                'placeholder_message_id': row[5],
+                'attempts': row[6] + 1,
+                'answer': row[7],
+                'resumed': True,
+                'keys': keys
+            }
+            bot = bots_by_id.get(entry['bot_id'])
+            try:
+                if bot and entry['stage'] == 'answered' and entry['answer'] and entry['placeholder_message_id']:
+                    logging.info(f"Delivering saved answer of interrupted update {entry['update_id']}")
+                    await deliver_answer(bot, entry['chat_id'], entry['placeholder_message_id'], entry['answer'])
+                    await finish_update(entry, 'completed')
+                else:
+                    await finalize_interrupted_update(bot, entry)
+            except Exception as e:
+                logging.error(f"Could not recover update {entry['update_id']}: {e}")
+                await finish_update(entry, 'failed')
+        finally:
+            ledger_in_flight.difference_update(keys)
+
+async def sweep_interrupted_updates(bots: List[Bot]):
+    """Run recover_interrupted_updates at startup and then periodically"""
+    while True:
+        try:
+            await recover_interrupted_updates(bots)
+        except Exception as e:
+            logging.error(f"Ledger sweep failed: {e}")
+        await asyncio.sleep(LEDGER_SWEEP_INTERVAL_SECONDS)
+
 def create_main_keyboard(language: str) -> InlineKeyboardMarkup:
     """Create main menu keyboard"""
     builder = InlineKeyboardBuilder()
@@ -274,16 +916,16 @@ def create_main_keyboard(language: str) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 @dp.message(CommandStart())
-async def command_start_handler(message: Message) -> None:
+async def command_start_handler(message: Message, bot: Bot) -> None:
     """Handle /start command"""
-    await update_user_profile(message)
+    await update_user_profile(bot.id, message)
     user_lang = await detect_language(message.text) if len(message.text) > 6 else 'mixed'
     
     if user_lang == 'georgian':
         welcome_text = f"""
 👋 გამარჯობა, <b>{message.from_user.full_name}</b>!
 
-🤖 მე ვარ შენი პერსონალური AI ასისტენტი, რომელიც იყენებს <code>{ANTHROPIC_MODEL}</code> მოდელს.
+🤖 მე ვარ შენი პერსონალური AI ასისტენტი, რომელიც მუშაობს Claude-ის მოდელებზე.
 
 ✨ <b>რას შემიძლია:</b>
 • ვუპასუხო ნებისმიერ კითხვას ქართულად და ინგლისურად
@@ -297,7 +939,7 @@ async def command_start_handler(message: Message) -> None:
         welcome_text = f"""
 👋 Hello, <b>{message.from_user.full_name}</b>!
 
-🤖 I'm your personal AI assistant powered by <code>{ANTHROPIC_MODEL}</code>.
+🤖 I'm your personal AI assistant powered by Claude models.
 
 ✨ <b>What I can do:</b>
 • Answer any questions in Georgian and English
@@ -312,9 +954,9 @@ async def command_start_handler(message: Message) -> None:
     await message.answer(welcome_text, reply_markup=keyboard)
 
 @dp.message(Command("newchat"))
-async def newchat_handler(message: Message) -> None:
+async def newchat_handler(message: Message, bot: Bot) -> None:
     """Handle /newchat command"""
-    await clear_user_context(message.from_user.id)
+    await clear_user_context(bot.id, message.from_user.id)
     user_lang = await detect_language(message.text) if len(message.text) > 8 else 'mixed'
     
     if user_lang == 'georgian':
@@ -325,9 +967,9 @@ async def newchat_handler(message: Message) -> None:
     await message.answer(text)
 
 @dp.message(Command("stats"))
-async def stats_handler(message: Message) -> None:
+async def stats_handler(message: Message, bot: Bot) -> None:
     """Handle /stats command"""
-    stats = await get_user_stats(message.from_user.id)
+    stats = await get_user_stats(bot.id, message.from_user.id)
     user_lang = await detect_language(message.text) if len(message.text) > 6 else 'mixed'
     
     if stats:
@@ -352,32 +994,72 @@ async def stats_handler(message: Message) -> None:
     
     await message.answer(text)
 
+@dp.message(Command("routing"))
+async def routing_handler(message: Message, bot: Bot) -> None:
+    """Handle /routing command (admin only): model routing statistics"""
+    if not ADMIN_USER_ID or str(message.from_user.id) != ADMIN_USER_ID:
+        return
+    
+    stats = await get_routing_stats(bot.id)
+    if not stats:
+        await message.answer("📈 No routing data yet.")
+        return
+    
+    lines = ["📈 <b>Model routing (last 7 days):</b>\n"]
+    for row in stats:
+        lines.append(
+            f"<b>{row['tier']}</b> <code>{row['model']}</code>\n"
+            f"  requests: {row['requests']} (failed: {row['failures']}, cut off: {row['truncated']})\n"
+            f"  avg latency: {row['avg_latency_ms']} ms\n"
+            f"  tokens in/out: {row['input_tokens']}/{row['output_tokens']}"
+        )
+    await message.answer("\n".join(lines))
+
 @dp.message(F.text)
-async def message_handler(message: Message):
-    """Handle text messages with AI response"""
+async def message_handler(message: Message, bot: Bot, ledger_entry: Optional[Dict] = None):
+    """Handle text messages with AI response.
+    
+    Progress is recorded in the update ledger, so a turn interrupted by a
+    restart resumes from its last stage instead of starting over.
+    """
+    stage = ledger_entry['stage'] if ledger_entry else 'received'
+    
     # Update user profile
-    await update_user_profile(message)
+    if stage == 'received':
+        await update_user_profile(bot.id, message)
     
     # Detect language
     user_lang = await detect_language(message.text)
     
-    # Show thinking message
-    if user_lang == 'georgian':
-        thinking_msg = await message.answer("🤔 ვფიქრობ...")
+    # Show thinking message (reuse the one sent before an interruption)
+    if ledger_entry and ledger_entry['placeholder_message_id']:
+        placeholder_id = ledger_entry['placeholder_message_id']
     else:
-        thinking_msg = await message.answer("🤔 Thinking...")
+        if user_lang == 'georgian':
+            thinking_msg = await message.answer("🤔 ვფიქრობ...")
+        else:
+            thinking_msg = await message.answer("🤔 Thinking...")
+        placeholder_id = thinking_msg.message_id
+        await advance_update(ledger_entry, 'placeholder', placeholder_id)
     
     user_id = message.from_user.id
     
     try:
+        # Answer already generated before an interruption: just deliver it
+        if stage == 'answered' and ledger_entry['answer']:
+            await deliver_answer(bot, message.chat.id, placeholder_id, ledger_entry['answer'])
+            await finish_update(ledger_entry, 'completed')
+            return
+        
         # Add user message to context
-        await add_message_to_context(user_id, "user", message.text)
+        if stage in ('received', 'placeholder'):
+            await add_message_to_context(bot.id, user_id, "user", message.text, ledger_entry, 'context')
         
         # Get conversation context
-        context_messages = await get_user_context(user_id)
+        context_messages = await get_user_context(bot.id, user_id)
         
-        # Choose system prompt based on detected language
-        system_prompt = SYSTEM_PROMPTS.get(user_lang, SYSTEM_PROMPTS['mixed'])
+        # Choose the tenant's system prompt based on detected language
+        system_prompt = get_system_prompt(bot.id, user_lang)
         
         # Telegram formatting instructions
         telegram_format_prompt = """
@@ -407,45 +1089,53 @@ When formatting responses for Telegram, use these conventions:
         # Add conversation context
         api_messages.extend(context_messages)
         
+        # Route the turn to a model tier
+        preferences = await get_user_preferences(bot.id, user_id)
+        route = route_model(message.text, user_lang, len(context_messages), preferences['response_style'])
+        
         # Call Anthropic API
-        response = anthropic_client.messages.create(
-            model=ANTHROPIC_MODEL,
-            messages=api_messages,
-            max_tokens=3000,
-            temperature=0.7
-        )
+        response = await call_model(bot.id, user_id, route, api_messages)
+        
+        # The fast tier ran out of tokens: retry on the standard tier rather
+        # than sending a cut-off answer
+        if route['tier'] == 'fast' and response.stop_reason == 'max_tokens':
+            route = {'tier': 'standard', 'reason': 'fast_truncated', **MODEL_TIERS['standard']}
+            response = await call_model(bot.id, user_id, route, api_messages)
         
         ai_answer = response.content[0].text
         
         # Add AI response to context
-        await add_message_to_context(user_id, "assistant", ai_answer)
+        await add_message_to_context(bot.id, user_id, "assistant", ai_answer, ledger_entry, 'answered')
         
         # Format for Telegram
         formatted_answer = telegram_format(ai_answer)
         
         # Edit the thinking message with the response
-        await thinking_msg.edit_text(formatted_answer)
+        await bot.edit_message_text(formatted_answer, chat_id=message.chat.id, message_id=placeholder_id)
+        await finish_update(ledger_entry, 'completed')
         
     except APIError as e:
         logging.error(f"Anthropic API error: {e}")
         error_msg = "😕 API error occurred. Please try again later." if user_lang == 'english' else "😕 API შეცდომა მოხდა. სცადეთ მოგვიანებით."
-        await thinking_msg.edit_text(error_msg)
+        await bot.edit_message_text(error_msg, chat_id=message.chat.id, message_id=placeholder_id)
+        await finish_update(ledger_entry, 'failed')
         
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
         error_msg = "😕 Something went wrong. Please contact admin." if user_lang == 'english' else "😕 რაღაც არასწორად მოხდა. დაუკავშირდით ადმინს."
-        await thinking_msg.edit_text(error_msg)
+        await bot.edit_message_text(error_msg, chat_id=message.chat.id, message_id=placeholder_id)
+        await finish_update(ledger_entry, 'failed')
 
 # Callback query handlers
 @dp.callback_query(F.data == "newchat")
-async def callback_newchat(callback):
-    await clear_user_context(callback.from_user.id)
+async def callback_newchat(callback, bot: Bot):
+    await clear_user_context(bot.id, callback.from_user.id)
     await callback.answer("🗑️ Context cleared!")
     await callback.message.edit_text("🗑️ Conversation context cleared!\nYou can start a new topic now.")
 
 @dp.callback_query(F.data == "stats")
-async def callback_stats(callback):
-    stats = await get_user_stats(callback.from_user.id)
+async def callback_stats(callback, bot: Bot):
+    stats = await get_user_stats(bot.id, callback.from_user.id)
     if stats:
         text = f"""
 📊 <b>Your Statistics:</b>
@@ -492,15 +1182,27 @@ async def main() -> None:
     # Initialize database
     await init_db()
     
-    # Initialize bot
-    bot = Bot(
-        token=TELEGRAM_TOKEN, 
-        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-    )
+    # Initialize one bot per tenant; all of them share a single HTTP session
+    json_loads, json_dumps, json_backend = get_json_backend()
+    session = AiohttpSession(json_loads=json_loads, json_dumps=json_dumps)
+    logging.info(f"JSON backend: {json_backend}")
+    bots = [
+        Bot(
+            token=tenant['token'],
+            session=session,
+            default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+        )
+        for tenant in TENANTS.values()
+    ]
     
     # Start polling
-    logging.info("🚀 AI Personal Assistant Bot started!")
-    await dp.start_polling(bot)
+    tenant_names = ", ".join(tenant['name'] for tenant in TENANTS.values())
+    logging.info(f"🚀 AI Personal Assistant Bot started! Tenants: {tenant_names}")
+    sweeper = asyncio.create_task(sweep_interrupted_updates(bots))
+    try:
+        await dp.start_polling(*bots)
+    finally:
+        sweeper.cancel()
 
 if __name__ == "__main__":
     logging.basicConfig(
@@ -508,4 +1210,6 @@ if __name__ == "__main__":
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         stream=sys.stdout
     )
+    event_loop = install_event_loop()
+    logging.info(f"Runtime profile: {RUNTIME_PROFILE} (event loop: {event_loop})")
     asyncio.run(main())